@@ -1,7 +1,18 @@
 import os
-import tempfile
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import hashlib
+from functools import wraps
+from contextlib import asynccontextmanager
+from collections import OrderedDict
 import aiohttp
+import httpx
 from telegram import Update, ReplyKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -10,7 +21,7 @@ from telegram.ext import (
     ContextTypes
 )
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
 
 # Load environment variables
 load_dotenv()
@@ -21,114 +32,310 @@ FASTAPI_URL = os.getenv("FASTAPI_URL")
 
 # Parse authorized chat IDs
 raw_ids = os.getenv("AUTHORIZED_CHAT_ID", "")
-AUTHORIZED_CHAT_IDS = [int(x) for x in raw_ids.split(",") if x.strip().isdigit()]
+AUTHORIZED_CHAT_IDS: frozenset[int] = frozenset(int(x) for x in raw_ids.split(",") if x.strip().isdigit())
 
-# Initialize OpenAI Client
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Initialize OpenAI Client on a keep-alive HTTP/2 connection pool
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=90),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+# SDK retries are disabled: chat_completion() retries outside OAI_SEM instead
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=openai_http_client, max_retries=0)
+
+# Shared aiohttp session for FastAPI calls, created on startup
+http_session: aiohttp.ClientSession | None = None
+
+# Limit concurrent uploads to the FastAPI ASR server so bursts queue here instead of overloading it
+ASR_SEM = asyncio.Semaphore(int(os.getenv("ASR_MAX_CONCURRENCY", "4")))
+
+# Limit concurrent OpenAI calls to stay under the account's rate limits
+OAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")))
+OPENAI_MAX_ATTEMPTS = 3
+# Longest server-requested wait (retry-after header) we are willing to honour, in seconds
+OPENAI_MAX_RETRY_AFTER = 60
+OPENAI_RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# Admission limits so a single oversized request can't monopolize the OpenAI budget
+MAX_CHARS = 4000
+MAX_COMPLETION_TOKENS = 1024
+
+# Seconds the server asked us to wait via retry-after-ms / retry-after, or None
+def openai_retry_after(error) -> float | None:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            delay = float(response.headers["retry-after-ms"]) / 1000
+        elif "retry-after" in response.headers:
+            value = response.headers["retry-after"]
+            try:
+                delay = float(value)
+            except ValueError:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        else:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return delay if 0 <= delay <= OPENAI_MAX_RETRY_AFTER else None
+
+# Chat completion with exponential backoff on rate limiting and transient errors.
+# Used as an async context manager so OAI_SEM stays held while a streamed response is read.
+@asynccontextmanager
+async def chat_completion(messages, **kwargs):
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        async with OAI_SEM:
+            try:
+                resp = await client.chat.completions.create(model="gpt-4o", messages=messages, **kwargs)
+            except OPENAI_RETRYABLE_ERRORS as e:
+                if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                    raise
+                error = e
+            else:
+                yield resp
+                return
+        delay = max(openai_retry_after(error) or 0, 2 ** attempt + random.uniform(0, 1))
+        print(f"⏳ OpenAI {type(error).__name__}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+# Small in-memory LRU cache whose entries expire after a fixed TTL
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+translation_cache = TTLCache(maxsize=10_000, ttl=86400)
+
+# English replies for recently handled voice notes, keyed by Telegram's file_unique_id
+# (stable for the same audio, including forwarded copies)
+voice_cache = TTLCache(maxsize=1024, ttl=3600)
+
+# Minimum seconds between edits of a streamed reply (Telegram throttles message edits)
+STREAM_EDIT_INTERVAL = 1.0
+
+# Seconds Telegram asked us to wait (an int in older PTB releases, a timedelta in newer ones)
+def retry_after_seconds(e: RetryAfter) -> float:
+    delay = e.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else delay
+
+# Send a reply/edit, waiting out Telegram flood control once before giving up
+async def send_with_flood_retry(send, text: str):
+    try:
+        return await send(text)
+    except RetryAfter as e:
+        delay = retry_after_seconds(e)
+        print(f"⏳ Telegram flood control, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        return await send(text)
+
+# Translate Somali text to English and reply, streaming the translation as it is generated.
+# Cached translations of identical text are sent straight away. Returns the English text,
+# or None if the model produced no text or stopped early (such results are not cached).
+async def reply_translation(message, somali_text: str) -> str | None:
+    key = hashlib.blake2b(somali_text.encode(), digest_size=16).digest()
+    english_text = translation_cache.get(key)
+    if english_text is not None:
+        await message.reply_text(english_text)
+        return english_text
+
+    reply = None
+    shown = ""
+    parts = []
+    finish_reason = None
+    next_edit = time.monotonic()
+    async with chat_completion([
+        {"role": "system", "content": "You are a helpful translation assistant. Only return the direct English translation, no explanation."},
+        {"role": "user", "content": f"Translate this Somali text into English:\n\n{somali_text}"}
+    ], stream=True, max_tokens=MAX_COMPLETION_TOKENS) as stream:
+        # Close the HTTP stream even if reading or replying fails part-way
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                parts.append(chunk.choices[0].delta.content or "")
+                partial = "".join(parts).strip()
+                if not partial or partial == shown or time.monotonic() < next_edit:
+                    continue
+                # Progress updates are best-effort; only the final send below decides success
+                try:
+                    if reply is None:
+                        reply = await message.reply_text(partial)
+                    else:
+                        await reply.edit_text(partial)
+                except RetryAfter as e:
+                    print(f"⚠️ Skipped progress update: {e}")
+                    next_edit = time.monotonic() + retry_after_seconds(e)
+                    continue
+                except BadRequest as e:
+                    print(f"⚠️ Skipped progress update: {e}")
+                    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+                    continue
+                shown = partial
+                next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        finally:
+            await stream.response.aclose()
+
+    english_text = "".join(parts).strip()
+    if not english_text:
+        print(f"⚠️ Empty translation (finish_reason={finish_reason})")
+        await message.reply_text("⚠️ Could not translate this message.")
+        return None
+
+    complete = finish_reason == "stop"
+    if complete:
+        translation_cache.set(key, english_text)
+    if reply is None:
+        await send_with_flood_retry(message.reply_text, english_text)
+    elif english_text != shown:
+        await send_with_flood_retry(reply.edit_text, english_text)
+    return english_text if complete else None
+
+# Replies for the reply-keyboard menu buttons
+MENU = {
+    "help": "🆘 What do you need help with?",
+    "write": "✍️ Please type what you'd like me to help you write.",
+    "record": "🎙️ Please send a voice message.",
+}
+MENU_MAX_LEN = max(len(k) for k in MENU)
+
+# Plain text messages that are not bot commands
+TEXT_NONCMD = filters.TEXT & ~filters.COMMAND
 
 # Authorization Check
 def is_authorized(chat_id: int) -> bool:
     return chat_id in AUTHORIZED_CHAT_IDS
 
+# Handler decorator that rejects chats outside AUTHORIZED_CHAT_IDS
+def authorized(handler):
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not is_authorized(update.effective_chat.id):
+            return await update.message.reply_text("❌ You are not authorised to use this bot.")
+        return await handler(update, context)
+    return wrapper
+
 # /start command handler
+@authorized
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update.effective_chat.id):
-        return await update.message.reply_text("❌ You are not authorised to use this bot.")
     keyboard = [["Help", "Write", "Record"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text("Hi! Please choose an option below:", reply_markup=reply_markup)
 
 # Handle text messages
+@authorized
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update.effective_chat.id):
-        return await update.message.reply_text("❌ You are not authorised to use this bot.")
-    text = update.message.text.strip().lower()
+    text = update.message.text.strip()
 
-    if text == "help":
-        return await update.message.reply_text("🆘 What do you need help with?")
-    elif text == "write":
-        return await update.message.reply_text("✍️ Please type what you'd like me to help you write.")
-    elif text == "record":
-        return await update.message.reply_text("🎙️ Please send a voice message.")
+    # Only short messages can be menu keywords, so skip lowercasing everything else
+    if len(text) <= MENU_MAX_LEN:
+        reply = MENU.get(text.lower())
+        if reply:
+            return await update.message.reply_text(reply)
+
+    if len(text) > MAX_CHARS:
+        return await update.message.reply_text("⚠️ Message too long, please split it into smaller parts.")
 
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a helpful translation assistant. Only return the direct English translation, no explanation."},
-                {"role": "user", "content": f"Translate this Somali text into English:\n\n{text}"}
-            ]
-        )
-        await update.message.reply_text(resp.choices[0].message.content.strip())
+        await reply_translation(update.message, text)
     except Exception as e:
         print(f"⚠️ Text Error: {e}")
         await update.message.reply_text("⚠️ Error while processing your message.")
 
 # Handle voice messages
+@authorized
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_authorized(update.effective_chat.id):
-        return await update.message.reply_text("❌ You are not authorised to use this bot.")
     voice = update.message.voice
     if not voice:
         return await update.message.reply_text("⚠️ No voice message detected.")
 
-    file = await context.bot.get_file(voice.file_id)
-    audio_path = ""
+    # Same audio already transcribed and translated: skip download, ASR and GPT
+    english_text = voice_cache.get(voice.file_unique_id)
+    if english_text is not None:
+        return await update.message.reply_text(english_text)
 
     try:
-        # Download voice file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as f:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                async with session.get(file.file_path) as resp:
-                    f.write(await resp.read())
-            audio_path = f.name
+        # Download voice file into memory
+        file = await voice.get_file()
+        audio = await file.download_as_bytearray()
 
         # Send audio to FastAPI ASR model
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
-            with open(audio_path, "rb") as audio_file:
-                form = aiohttp.FormData()
-                form.add_field('file', audio_file, filename="voice.ogg", content_type='audio/ogg')
-                async with session.post(FASTAPI_URL, data=form) as resp:
-                    if resp.status != 200:
-                        error_text = await resp.text()
-                        raise Exception(f"FastAPI Error {resp.status}: {error_text}")
-
-                    try:
-                        fastapi_result = await resp.json()
-                        print(f"🌍 FastAPI response: {fastapi_result}")
-                    except Exception as parse_err:
-                        raw_text = await resp.text()
-                        raise Exception(f"Failed to parse FastAPI response. Raw: {raw_text}, Error: {parse_err}")
-
-                    if not fastapi_result or not isinstance(fastapi_result, dict):
-                        raise Exception(f"FastAPI returned invalid response: {fastapi_result}")
-
-                    somali_text = fastapi_result.get("transcription", "")
-                    english_text = fastapi_result.get("translation", "")
+        form = aiohttp.FormData()
+        form.add_field('file', audio, filename="voice.ogg", content_type='audio/ogg')
+        async with ASR_SEM, http_session.post(FASTAPI_URL, data=form) as resp:
+            if resp.status != 200:
+                error_text = await resp.text()
+                raise Exception(f"FastAPI Error {resp.status}: {error_text}")
+
+            try:
+                fastapi_result = await resp.json()
+                print(f"🌍 FastAPI response: {fastapi_result}")
+            except Exception as parse_err:
+                raw_text = await resp.text()
+                raise Exception(f"Failed to parse FastAPI response. Raw: {raw_text}, Error: {parse_err}")
+
+            if not fastapi_result or not isinstance(fastapi_result, dict):
+                raise Exception(f"FastAPI returned invalid response: {fastapi_result}")
+
+            somali_text = fastapi_result.get("transcription", "")
+            english_text = fastapi_result.get("translation", "")
 
         if not somali_text:
             return await update.message.reply_text("⚠️ Could not transcribe the voice message.")
 
         if not english_text:
             # Backup: If translation missing, fallback to GPT
-            translation = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "Translate this Somali text into English. Only return the English translation, no explanation."},
-                    {"role": "user", "content": somali_text}
-                ]
-            )
-            english_text = translation.choices[0].message.content.strip()
+            english_text = await reply_translation(update.message, somali_text)
+        else:
+            await update.message.reply_text(english_text)
 
-        await update.message.reply_text(english_text)
+        if english_text:
+            voice_cache.set(voice.file_unique_id, english_text)
 
     except Exception as e:
         print(f"⚠️ Voice Error: {e}")
         await update.message.reply_text(f"⚠️ Error: {e}")
 
-    finally:
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
+# Open the shared HTTP session on startup
+async def on_startup(app):
+    global http_session
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=60, connect=5)
+    )
+
+    # Warm up the ASR server and open a pooled connection before the first voice message.
+    # Any HTTP status is fine here; only connection failures are reported.
+    try:
+        async with http_session.get(FASTAPI_URL) as resp:
+            print(f"🔥 FastAPI warm-up: HTTP {resp.status}")
+    except Exception as e:
+        print(f"⚠️ FastAPI warm-up failed: {e}")
+
+# Release the HTTP and OpenAI connection pools on shutdown
+async def on_shutdown(app):
+    if http_session:
+        await http_session.close()
+    await client.close()
 
 # Main app runner
 if __name__ == "__main__":
@@ -136,9 +343,27 @@ if __name__ == "__main__":
         print("🚨 Missing env vars or no authorized chat IDs set.")
         exit(1)
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Use the libuv-based event loop where it is available (not on Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # HTTP/2 connection pools for Bot API calls and for long polling
+        .request(HTTPXRequest(http_version="2", connection_pool_size=64))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        # Process updates concurrently so one slow voice message doesn't hold up the next
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(MessageHandler(TEXT_NONCMD, handle_message))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
 
     print("🤖 Bot is running... Make sure only one instance is active.")